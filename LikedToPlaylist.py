@@ -1,14 +1,97 @@
 ##############################################################################################################
 #final file
+import os
 import time
+import tempfile
+import functools
+import itertools
+import collections
+import threading
+import concurrent.futures
+from operator import itemgetter
+import requests
 import spotipy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from spotipy.exceptions import SpotifyException
+from spotipy.cache_handler import FlaskSessionCacheHandler
 from spotipy.oauth2 import SpotifyOAuth
+from pathlib import Path
 from flask import Flask, request, url_for, session, redirect, render_template
 
+SECRET_KEY_FILE = Path(__file__).with_name('.secret_key')
+
+def read_secret_key():
+    try:
+        return SECRET_KEY_FILE.read_bytes()
+    except FileNotFoundError:
+        return b''
+
+def load_secret_key():
+    # A fixed key keeps session cookies valid across restarts, so users don't have to log in again
+    secret_key = os.environ.get('SECRET_KEY')
+    if secret_key:
+        return secret_key
+    secret_key = read_secret_key()
+    if secret_key:
+        return secret_key
+    # First run: write the key to a private temp file, then move it into place in one step so
+    # processes starting at the same time never read a partial key
+    fd, tmp_path = tempfile.mkstemp(dir=SECRET_KEY_FILE.parent, prefix='.secret_key.')
+    try:
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(os.urandom(32))
+        try:
+            # link refuses to overwrite, so whichever process links first wins
+            os.link(tmp_path, SECRET_KEY_FILE)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp_path)
+    # Everyone uses the key that ended up on disk, whoever wrote it
+    secret_key = read_secret_key()
+    if not secret_key:
+        # Only a file written by something else can be empty, replacing it could split the key
+        raise RuntimeError(f'{SECRET_KEY_FILE} is empty, delete it to generate a new secret key')
+    return secret_key
+
 app = Flask(__name__)
 app.config['SESSION_COOKIE_NAME'] = 'Spotify Cookie'
-app.secret_key = 'YOUR_SECRET_KEY'
+app.secret_key = load_secret_key()
 TOKEN_INFO = 'token_info'
+USER_ID = 'user_id'
+# A fixed redirect URI skips building it from the request on every login and token refresh
+REDIRECT_URI = os.environ.get('SPOTIPY_REDIRECT_URI')
+# Spotify returns at most 50 liked songs per page and accepts at most 100 tracks per add
+PAGE_SIZE = 50
+ADD_CHUNK_SIZE = 100
+# Spotify starts rate limiting quickly, so keep at most 3 requests in flight at once
+MAX_CONCURRENT_REQUESTS = 3
+spotify_semaphore = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+# Worker threads for page fetches are shared by all requests instead of started per save.
+# Each save only keeps FETCH_WINDOW pages queued, so one big library can't hold the pool
+fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix='spotify')
+FETCH_WINDOW = MAX_CONCURRENT_REQUESTS
+# Rate limited or failing Spotify calls are retried this many times before giving up
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 30
+# Allow bursts of 10 Spotify calls, then 5 calls per second
+RATE_LIMIT_BURST = 10
+RATE_LIMIT_PER_SECOND = 5
+# One connection pool for every Spotipy client so TLS connections to api.spotify.com are reused.
+# The adapter only retries dropped connections. Status retries and Retry-After are turned off
+# so rate limits and server errors reach spotify_call, which pauses the shared bucket
+http_session = requests.Session()
+connection_retries = Retry(total=3, connect=3, read=3, status=0, backoff_factor=0.3, respect_retry_after_header=False)
+http_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=connection_retries))
+# Tokens refreshed in this process and one lock per refresh token, with a count of the
+# requests using it, both keyed by the refresh token they replaced. refresh_lock only
+# guards the two dicts, never an HTTP call
+refreshed_tokens = {}
+refresh_locks = {}
+refresh_lock = threading.Lock()
+# Seconds to wait for accounts.spotify.com before giving up on a token exchange or refresh
+OAUTH_TIMEOUT = 10
 
 # Route to display the form for entering client_id and client_secret
 @app.route('/config', methods=['GET', 'POST'])
@@ -54,45 +137,207 @@ def save_liked():
         return redirect("/")
 
     # Create a Spotipy instance with the access token
-    sp = spotipy.Spotify(auth=token_info['access_token'])
-    user_id = sp.current_user()['id']
+    sp = create_spotify_client(token_info['access_token'])
+    user_id = get_user_id(sp)
     # Get the user's playlists
-    new_playlist = sp.user_playlist_create(user_id, 'cadence', True)
+    new_playlist = spotify_call(sp.user_playlist_create, user_id, 'cadence', True)
     new_playlist_id = new_playlist['id']
-    temp=set()
-    for i in range(28):
-        saved = sp.current_user_saved_tracks(50, 50 * i)
-        song_uris = set()
-        for song in saved['items']:
-            song_uri = song['track']['uri']
-            if song_uri not in temp:
-                song_uris.add(song_uri)
-        if song_uris:
-            sp.user_playlist_add_tracks(user_id, new_playlist_id, song_uris, None)
-
+    # The first page tells us how many liked songs there are
+    first_page = spotify_call(sp.current_user_saved_tracks, PAGE_SIZE, 0)
+    total = first_page['total']
+    # Fetch the next pages in the background while the pages that already arrived are added
+    pages = fetch_pages(sp, range(PAGE_SIZE, total, PAGE_SIZE))
+    try:
+        song_uris = track_uris(itertools.chain([first_page], pages))
+        # Add the songs in order, concurrent adds to one playlist would shuffle the chunks
+        for chunk in chunked(song_uris, ADD_CHUNK_SIZE):
+            spotify_call(sp.user_playlist_add_tracks, user_id, new_playlist_id, chunk, None)
+    finally:
+        # Stop fetching pages for a save that failed part way
+        pages.close()
 
     return render_template('saved.html')
 
+def fetch_pages(sp, offsets):
+    # Yield pages in library order, keeping FETCH_WINDOW fetches queued ahead of the consumer
+    offsets = iter(offsets)
+    pending = collections.deque()
+    def submit(count):
+        for offset in itertools.islice(offsets, count):
+            pending.append(fetch_pool.submit(spotify_call, sp.current_user_saved_tracks, PAGE_SIZE, offset))
+    submit(FETCH_WINDOW)
+    try:
+        while pending:
+            page = pending.popleft().result()
+            submit(1)
+            yield page
+    finally:
+        for future in pending:
+            future.cancel()
+
+get_track = itemgetter('track')
+
+def track_uris(pages):
+    # A library holds each liked song once, so the URIs need no dedupe
+    for saved in pages:
+        # Skip songs whose track is no longer available
+        yield from (track['uri'] for track in map(get_track, saved['items']) if track)
+
+def chunked(iterable, size):
+    # Lazily split an iterable into lists of at most size items
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, size)), [])
+
+class TokenBucket:
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def acquire(self):
+        # Take a token, going into debt if none are left, then sleep off the debt outside the lock
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.refill_rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Hold every caller back for at least the given number of seconds
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, -seconds * self.refill_rate)
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_if_paused(self):
+        # Callers that took a token before a pause still have to sit out the rest of it
+        with self.lock:
+            wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+spotify_bucket = TokenBucket(RATE_LIMIT_BURST, RATE_LIMIT_PER_SECOND)
+
+def spotify_call(fn, *args, **kwargs):
+    for attempt in range(MAX_ATTEMPTS):
+        # Stay under Spotify's rate limit instead of finding it through 429s
+        spotify_bucket.acquire()
+        backoff = 0
+        # Share the concurrency budget with every other Spotify request in the process
+        with spotify_semaphore:
+            spotify_bucket.wait_if_paused()
+            try:
+                return fn(*args, **kwargs)
+            except SpotifyException as e:
+                last_attempt = attempt == MAX_ATTEMPTS - 1
+                if e.http_status == 429 and not last_attempt:
+                    # Wait as long as Spotify asks, fall back to exponential backoff. The
+                    # whole bucket is paused so other calls don't hit the same limit
+                    retry_after = retry_after_seconds(e)
+                    if retry_after is None:
+                        retry_after = min(2 ** attempt, MAX_BACKOFF)
+                    elif retry_after > MAX_BACKOFF:
+                        # Spotify wants us gone for longer than a request can wait
+                        raise
+                    spotify_bucket.pause(retry_after)
+                elif e.http_status is not None and e.http_status >= 500 and not last_attempt:
+                    backoff = min(2 ** attempt, MAX_BACKOFF)
+                else:
+                    raise
+        # Back off from server errors without holding a semaphore slot
+        if backoff:
+            time.sleep(backoff)
+
+def retry_after_seconds(e):
+    # Retry-After may be missing or an HTTP date, only a number of seconds is used
+    try:
+        return max(int((e.headers or {}).get('Retry-After')), 0)
+    except (TypeError, ValueError):
+        return None
+
 def get_token():
     token_info = session.get(TOKEN_INFO, None)
     if not token_info:
         # If the token info is not found, redirect the user to the login route
         redirect(url_for('login', _external=False))
     # Check if the token is expired and refresh it if necessary
-    now = int(time.time())
-    is_expired = token_info['expires_at'] - now < 60
-    if is_expired:
-        spotify_oauth = create_spotify_oauth()
-        token_info = spotify_oauth.refresh_access_token(token_info['refresh_token'])
+    if is_token_expired(token_info):
+        token_info = refresh_access_token(token_info)
     return token_info
 
+def get_user_id(sp):
+    # Reuse the user id from earlier in this session instead of asking Spotify again
+    user_id = session.get(USER_ID)
+    if not user_id:
+        user_id = spotify_call(sp.current_user)['id']
+        session[USER_ID] = user_id
+    return user_id
+
+def is_token_expired(token_info):
+    now = int(time.time())
+    return token_info['expires_at'] - now < 60
+
+def refresh_access_token(token_info):
+    refresh_token = token_info['refresh_token']
+    with refresh_lock:
+        entry = refresh_locks.setdefault(refresh_token, {'lock': threading.Lock(), 'users': 0})
+        entry['users'] += 1
+    try:
+        # Requests that arrive together for the same user share a single refresh,
+        # while refreshes for other users go ahead in parallel
+        with entry['lock']:
+            refreshed = refreshed_tokens.get(refresh_token)
+            if not refreshed or is_token_expired(refreshed):
+                refreshed = create_spotify_oauth().refresh_access_token(refresh_token)
+                with refresh_lock:
+                    refreshed_tokens[refresh_token] = refreshed
+    finally:
+        with refresh_lock:
+            entry['users'] -= 1
+            prune_refreshed_tokens()
+    # Requests that reused another request's refresh need the new token in their own cookie too
+    session[TOKEN_INFO] = refreshed
+    return refreshed
+
+def prune_refreshed_tokens():
+    # Drop entries nobody can use anymore so the dicts don't grow with every refresh.
+    # Entries still counted as in use belong to a request that is about to take their lock
+    for key, entry in list(refresh_locks.items()):
+        refreshed = refreshed_tokens.get(key)
+        if not entry['users'] and (refreshed is None or is_token_expired(refreshed)):
+            del refresh_locks[key]
+            refreshed_tokens.pop(key, None)
+
+def create_spotify_client(access_token):
+    # Retries are handled by spotify_call, the shared session only pools connections
+    return spotipy.Spotify(auth=access_token, requests_session=http_session)
+
 def create_spotify_oauth(client_id=None, client_secret=None):
-    
+    redirect_uri = REDIRECT_URI or url_for('redirect_page', _external=True)
+    return build_spotify_oauth(client_i, client_secre, redirect_uri)
+
+# The OAuth settings only change when /config is submitted, so reuse the built object
+@functools.lru_cache(maxsize=2)
+def build_spotify_oauth(client_id, client_secret, redirect_uri):
     return SpotifyOAuth(
-        client_id=client_i,
-        client_secret=client_secre,
-        redirect_uri=url_for('redirect_page', _external=True),
-        scope='user-library-read playlist-modify-public playlist-modify-private'
+        client_id=client_id,
+        client_secret=client_secret,
+        redirect_uri=redirect_uri,
+        scope='user-library-read playlist-modify-public playlist-modify-private',
+        requests_timeout=OAUTH_TIMEOUT,
+        # The shared object keeps tokens in each user's own session rather than one .cache file
+        cache_handler=FlaskSessionCacheHandler(session)
     )
 
-app.run(debug=True)
+# Only start the development server when run directly, so a WSGI server can import the app
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,74 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SECRET_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import LikedToPlaylist
+from LikedToPlaylist import TOKEN_INFO, app
+
+
+class FakeOAuth:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def refresh_access_token(self, refresh_token):
+        with self.lock:
+            self.calls.append(refresh_token)
+        # Long enough for the other requests for this user to queue on its lock
+        time.sleep(0.1)
+        return {'access_token': 'new-' + refresh_token, 'refresh_token': refresh_token, 'expires_at': int(time.time()) + 3600}
+
+
+class RefreshAccessTokenTest(unittest.TestCase):
+    def setUp(self):
+        self.oauth = FakeOAuth()
+        for patcher in (
+            mock.patch.object(LikedToPlaylist, 'create_spotify_oauth', return_value=self.oauth),
+            mock.patch.dict(LikedToPlaylist.refreshed_tokens, clear=True),
+            mock.patch.dict(LikedToPlaylist.refresh_locks, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_concurrent_requests_share_one_refresh_per_user(self):
+        users = ['alice', 'bob']
+        per_user = 3
+        barrier = threading.Barrier(len(users) * per_user)
+        cookies = []
+
+        def request(refresh_token):
+            with app.test_request_context():
+                LikedToPlaylist.session[TOKEN_INFO] = {'access_token': 'old', 'refresh_token': refresh_token, 'expires_at': 0}
+                barrier.wait()
+                LikedToPlaylist.get_token()
+                cookies.append(LikedToPlaylist.session[TOKEN_INFO])
+
+        threads = [threading.Thread(target=request, args=(user,)) for user in users for _ in range(per_user)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(self.oauth.calls), users)
+        self.assertEqual(sorted(cookie['access_token'] for cookie in cookies), sorted(['new-' + user for user in users] * per_user))
+        self.assertEqual(LikedToPlaylist.refresh_locks.keys(), set(users))
+        self.assertTrue(all(not entry['users'] for entry in LikedToPlaylist.refresh_locks.values()))
+
+    def test_prune_keeps_entries_in_use(self):
+        LikedToPlaylist.refresh_locks['waiting'] = {'lock': threading.Lock(), 'users': 1}
+        LikedToPlaylist.refresh_locks['idle'] = {'lock': threading.Lock(), 'users': 0}
+        LikedToPlaylist.refreshed_tokens['expired'] = {'expires_at': 0}
+        LikedToPlaylist.refresh_locks['expired'] = {'lock': threading.Lock(), 'users': 0}
+        LikedToPlaylist.prune_refreshed_tokens()
+        self.assertEqual(LikedToPlaylist.refresh_locks.keys(), {'waiting'})
+        self.assertEqual(LikedToPlaylist.refreshed_tokens, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SECRET_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import LikedToPlaylist
+from LikedToPlaylist import ADD_CHUNK_SIZE, FETCH_WINDOW, PAGE_SIZE, app
+from spotipy.exceptions import SpotifyException
+
+
+def liked_library(total):
+    # Every seventh saved item has no track, like a song removed from Spotify
+    return [None if i % 7 == 3 else {'uri': 'spotify:track:%d' % i} for i in range(total)]
+
+
+class SaveLikedTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch.object(LikedToPlaylist, 'spotify_bucket', LikedToPlaylist.TokenBucket(1000, 1000)),
+            mock.patch.object(LikedToPlaylist, 'get_token', return_value={'access_token': 'token'}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fake_spotify(self, library):
+        sp = mock.Mock()
+        sp.current_user.return_value = {'id': 'user'}
+        sp.user_playlist_create.return_value = {'id': 'playlist'}
+        sp.current_user_saved_tracks.side_effect = lambda limit, offset: {
+            'total': len(library),
+            'items': [{'track': track} for track in library[offset:offset + limit]],
+        }
+        return sp
+
+    def save_liked(self, sp):
+        with mock.patch.object(LikedToPlaylist, 'create_spotify_client', return_value=sp), app.test_request_context('/saveLiked'):
+            return LikedToPlaylist.save_liked()
+
+    def test_adds_library_in_order_in_chunks(self):
+        library = liked_library(537)
+        sp = self.fake_spotify(library)
+        self.save_liked(sp)
+
+        offsets = sorted(call.args[1] for call in sp.current_user_saved_tracks.call_args_list)
+        self.assertEqual(offsets, list(range(0, len(library), PAGE_SIZE)))
+        chunks = [call.args[2] for call in sp.user_playlist_add_tracks.call_args_list]
+        self.assertTrue(all(0 < len(chunk) <= ADD_CHUNK_SIZE for chunk in chunks))
+        self.assertEqual([uri for chunk in chunks for uri in chunk], [track['uri'] for track in library if track])
+
+    def test_failed_add_stops_fetching(self):
+        library = liked_library(100 * PAGE_SIZE)
+        sp = self.fake_spotify(library)
+        sp.user_playlist_add_tracks.side_effect = SpotifyException(404, -1, 'not found')
+        with self.assertRaises(SpotifyException):
+            self.save_liked(sp)
+        # Let fetches that were already running finish before counting
+        time.sleep(0.1)
+
+        # Filling the first chunk reads three pages, at most FETCH_WINDOW more are queued behind them
+        self.assertLessEqual(sp.current_user_saved_tracks.call_count, 3 + FETCH_WINDOW)
+        sp.user_playlist_add_tracks.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+os.environ.setdefault('SECRET_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import LikedToPlaylist
+from spotipy.exceptions import SpotifyException
+
+
+class RateLimitedHandler(BaseHTTPRequestHandler):
+    requests_seen = 0
+
+    def do_GET(self):
+        RateLimitedHandler.requests_seen += 1
+        self.send_response(429)
+        self.send_header('Retry-After', '0')
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"error": {"status": 429, "message": "rate limited"}}')
+
+    def log_message(self, *args):
+        pass
+
+
+class SpotifyCallTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RateLimitedHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:%d/' % self.server.server_port
+        # Route the local server through the same adapter Spotify calls use
+        LikedToPlaylist.http_session.mount(self.base_url, LikedToPlaylist.http_session.get_adapter('https://api.spotify.com'))
+        RateLimitedHandler.requests_seen = 0
+
+    def tearDown(self):
+        LikedToPlaylist.http_session.adapters.pop(self.base_url)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_429_sends_one_request_per_attempt(self):
+        sp = LikedToPlaylist.create_spotify_client('token')
+        sp.prefix = self.base_url
+        with mock.patch.object(LikedToPlaylist, 'MAX_ATTEMPTS', 2), mock.patch.object(LikedToPlaylist.time, 'sleep'):
+            with self.assertRaises(SpotifyException) as raised:
+                LikedToPlaylist.spotify_call(sp.current_user)
+        self.assertEqual(raised.exception.http_status, 429)
+        self.assertEqual(RateLimitedHandler.requests_seen, 2)
+
+
+class RetryAfterTest(unittest.TestCase):
+    def rate_limited(self, retry_after):
+        headers = {} if retry_after is None else {'Retry-After': retry_after}
+        return mock.Mock(side_effect=[SpotifyException(429, -1, 'rate limited', headers=headers), 'ok'])
+
+    def call(self, fn):
+        with mock.patch.object(LikedToPlaylist, 'spotify_bucket') as bucket:
+            return LikedToPlaylist.spotify_call(fn), bucket.pause
+
+    def test_numeric_retry_after_pauses_bucket(self):
+        result, pause = self.call(self.rate_limited('2'))
+        self.assertEqual(result, 'ok')
+        pause.assert_called_once_with(2)
+
+    def test_http_date_falls_back_to_backoff(self):
+        result, pause = self.call(self.rate_limited('Wed, 21 Oct 2026 07:28:00 GMT'))
+        self.assertEqual(result, 'ok')
+        pause.assert_called_once_with(1)
+
+    def test_retry_after_above_ceiling_raises(self):
+        fn = self.rate_limited(str(LikedToPlaylist.MAX_BACKOFF + 1))
+        with self.assertRaises(SpotifyException):
+            self.call(fn)
+        self.assertEqual(fn.call_count, 1)
+
+
+class PauseTest(unittest.TestCase):
+    def test_caller_holding_a_token_waits_out_a_pause(self):
+        called_at = {}
+        paused_at = []
+
+        def other():
+            called_at['other'] = time.monotonic()
+
+        other_thread = threading.Thread(target=LikedToPlaylist.spotify_call, args=(other,))
+
+        def rate_limited():
+            if paused_at:
+                return 'ok'
+            # The other caller takes its bucket token and queues on the semaphore before the 429
+            other_thread.start()
+            time.sleep(0.1)
+            paused_at.append(time.monotonic())
+            raise SpotifyException(429, -1, 'rate limited', headers={'Retry-After': '1'})
+
+        with mock.patch.object(LikedToPlaylist, 'spotify_bucket', LikedToPlaylist.TokenBucket(10, 5)), \
+                mock.patch.object(LikedToPlaylist, 'spotify_semaphore', threading.BoundedSemaphore(1)):
+            self.assertEqual(LikedToPlaylist.spotify_call(rate_limited), 'ok')
+            other_thread.join()
+        self.assertGreaterEqual(called_at['other'] - paused_at[0], 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()